@@ -1,5 +1,7 @@
-import os
+import argparse
 import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import utils
 import logging
@@ -7,7 +9,7 @@ import logging
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def main():
+def main(pretty=False):
     data_dir = Path("data")
     data_dir.mkdir(exist_ok=True)
     
@@ -22,25 +24,48 @@ def main():
         (day_30, "30-day")
     ]
     
-    for date_obj, label in dates_to_fetch:
-        date_str = date_obj.strftime("%Y-%m-%d")
-        logging.info(f"Fetching {label} data for {date_str}")
-        
-        url = f"https://tcgcsv.com/archive/tcgplayer/prices-{date_str}.ppmd.7z"
-        archive_name = f"prices-{date_str}.ppmd.7z"
-        archive_path = Path(archive_name)
+    # Prices from all days are merged so each product file is rewritten once
+    price_data = defaultdict(list)
+    target_categories = frozenset(utils.TARGET_CATEGORIES)
+    
+    # Download all archives concurrently; extraction stays on the main thread
+    with ThreadPoolExecutor(max_workers=len(dates_to_fetch)) as executor:
+        futures = {}
+        for date_obj, label in dates_to_fetch:
+            date_str = date_obj.strftime("%Y-%m-%d")
+            logging.info(f"Fetching {label} data for {date_str}")
+            
+            url = f"https://tcgcsv.com/archive/tcgplayer/prices-{date_str}.ppmd.7z"
+            
+            future = executor.submit(utils.download_to_buffer, url)
+            futures[future] = (label, date_str)
         
-        if utils.download_file(url, archive_path):
-            try:
-                utils.process_daily_data(archive_path, date_str, data_dir)
-                logging.info(f"Successfully processed {label} data for {date_str}")
-            except Exception as e:
-                logging.error(f"Failed to process {label} data for {date_str}: {e}")
-            finally:
-                if archive_path.exists():
-                    os.remove(archive_path)
-        else:
-            logging.warning(f"Failed to download {label} data for {date_str}")
+        for future in as_completed(futures):
+            label, date_str = futures[future]
+            archive = future.result()
+            
+            if archive is not None:
+                try:
+                    day_data = utils.extract_prices_from_archive(archive, date_str, target_categories)
+                    for key, records in day_data.items():
+                        price_data[key].extend(records)
+                    logging.info(f"Successfully extracted {label} data for {date_str}")
+                except Exception as e:
+                    logging.error(f"Failed to process {label} data for {date_str}: {e}")
+                finally:
+                    archive.close()
+            else:
+                logging.warning(f"Failed to download {label} data for {date_str}")
+    
+    if not price_data:
+        logging.warning("No price data extracted.")
+        return
+    
+    utils.update_product_files(price_data, data_dir, today, pretty)
+    logging.info("Daily update complete.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Update product price files from the TCGCSV archives.")
+    parser.add_argument('--pretty', action='store_true', help="Write indented JSON for easier reading")
+    args = parser.parse_args()
+    main(pretty=args.pretty)
@@ -1,12 +1,29 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import py7zr
+from py7zr.io import BytesIOFactory
 import json
 import logging
-import shutil
 import datetime
+import io
+import sys
+import tempfile
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import libarchive
+except (ImportError, OSError, AttributeError):
+    # libarchive-c is missing or the native libarchive could not be loaded
+    libarchive = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,150 +40,312 @@ TARGET_CATEGORIES = {
 }
 # ============================================================
 
+# Category, product and sub type strings repeat across every record, so
+# they are interned to share one copy per distinct value
+_intern = sys.intern
+
 # Price fields to track
 PRICE_FIELDS = ['lowPrice', 'midPrice', 'highPrice', 'marketPrice', 'directLowPrice']
 
+# A single day's prices for one product; fields match the JSON output keys
+PriceRecord = namedtuple('PriceRecord', ['date'] + PRICE_FIELDS)
+
+# Connect and read timeouts (seconds) for archive downloads
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Archives up to this size (bytes) are downloaded into memory, larger ones
+# into an anonymous temporary file
+IN_MEMORY_DOWNLOAD_LIMIT = 256 * 1024 * 1024
+
+# Upper bound on the size of a single decompressed prices file held in memory
+MAX_ENTRY_SIZE = 64 * 1024 * 1024
+
+
+def _create_session():
+    """Creates an HTTP session that reuses connections and retries transient failures."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    )
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared session so repeated downloads from tcgcsv.com reuse the TLS connection
+_SESSION = _create_session()
+
+
+def json_loads(data):
+    """Decodes JSON from bytes, using orjson when it is available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-def download_file(url, dest_path):
-    """Downloads a file from a URL to a destination path."""
-    logging.info(f"Downloading {url} to {dest_path}...")
+
+def json_dumps(obj, pretty=False):
+    """
+    Encodes an object as JSON bytes, using orjson when it is available.
+    
+    Output is compact unless pretty is set, which indents by 2 spaces.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else None)
+    if pretty:
+        return json.dumps(obj, indent=2).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def write_bytes(path, payload):
+    """
+    Writes a payload to a file with raw os calls.
+    
+    Skips the buffered file object, which costs extra fstat/ioctl/lseek
+    syscalls per file when writing many small files.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
     try:
-        response = requests.get(url, stream=True)
+        view = memoryview(payload)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+def parse_date(date_str):
+    """Parses a YYYY-MM-DD string into a date, much faster than strptime."""
+    return datetime.date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
+
+
+@lru_cache(maxsize=None)
+def date_ordinal(date_str):
+    """
+    Returns the ordinal of a YYYY-MM-DD string.
+    
+    Cached because every record from an archive carries the same date.
+    """
+    return parse_date(date_str).toordinal()
+
+
+def download_to_buffer(url):
+    """
+    Downloads a file from a URL without creating a named file on disk.
+    
+    Returns a binary file object positioned at the start, or None on failure.
+    """
+    logging.info(f"Downloading {url}...")
+    buf = None
+    try:
+        response = _SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
         response.raise_for_status()
-        with open(dest_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        
+        size = int(response.headers.get('Content-Length') or 0)
+        if 0 < size <= IN_MEMORY_DOWNLOAD_LIMIT:
+            buf = io.BytesIO()
+        else:
+            buf = tempfile.TemporaryFile()
+        
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            buf.write(chunk)
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to download {url}: {e}")
-        return False
+        if buf is not None:
+            buf.close()
+        return None
     
     # Verify file size
-    if os.path.getsize(dest_path) == 0:
-        logging.error(f"Downloaded file {dest_path} is empty.")
-        os.remove(dest_path)
-        return False
-        
+    if buf.tell() == 0:
+        logging.error(f"Downloaded file from {url} is empty.")
+        buf.close()
+        return None
+    
+    buf.seek(0)
     logging.info("Download complete.")
-    return True
+    return buf
 
 
-def extract_prices_from_archive(archive_path, date_str, target_categories):
+def _parse_prices_file(fname, date_str, data, price_data):
     """
-    Extracts price data from the archive for the specified categories.
+    Parses a single prices file from an archive into price_data.
+    """
+    category_id = _intern(fname.replace('\\', '/').split('/', 2)[1])
     
-    Returns a dict: (category_id, product_id, subTypeName) -> list of price records
+    try:
+        content = json_loads(data)
+        
+        items = []
+        if isinstance(content, dict) and 'results' in content:
+            items = content['results']
+        elif isinstance(content, list):
+            items = content
+        elif isinstance(content, dict):
+            items = [content]
+        else:
+            return
+        
+        # Bind globals to locals once for the hot loop below
+        fields = tuple(PRICE_FIELDS)
+        intern = _intern
+        new_record = PriceRecord
+        
+        for item in items:
+            product_id = item.get('productId')
+            
+            if not product_id:
+                continue
+            
+            prices = tuple(map(item.get, fields))
+            
+            sub_type = item.get('subTypeName', 'Normal')
+            if sub_type is not None:
+                sub_type = intern(sub_type)
+            
+            # Extract price data
+            record = new_record(date_str, *prices)
+            
+            key = (category_id, intern(str(product_id)), sub_type)
+            price_data[key].append(record)
+            
+    except json.JSONDecodeError:
+        logging.error(f"Failed to decode JSON in {fname}")
+    except Exception as e:
+        logging.error(f"Error processing file {fname}: {e}")
+
+
+def _read_entries_libarchive(archive, date_str, allowed_prefixes):
     """
-    logging.info(f"Extracting prices from {archive_path} for date {date_str}...")
+    Reads the target prices files from the archive with libarchive.
     
-    price_data = defaultdict(list)
+    Returns a list of (file name, date, raw bytes) tuples.
+    """
+    if isinstance(archive, (str, os.PathLike)):
+        reader = libarchive.file_reader(str(archive))
+    else:
+        reader = libarchive.stream_reader(archive)
     
-    try:
-        with py7zr.SevenZipFile(archive_path, mode='r') as z:
-            all_files = z.getnames()
+    entries = []
+    with reader as entry_iter:
+        for entry in entry_iter:
+            fname = entry.pathname
+            if not (fname.endswith(('/prices', '\\prices')) and fname.startswith(allowed_prefixes)):
+                continue
             
-            # Filter files for target categories
-            # Structure: {date}/{categoryId}/{groupId}/prices
-            files_to_process = []
-            for fname in all_files:
-                parts = fname.replace('\\', '/').split('/')
-                if len(parts) >= 4 and parts[1] in target_categories and parts[-1] == 'prices':
-                    files_to_process.append(fname)
+            if entry.size and entry.size > MAX_ENTRY_SIZE:
+                logging.error(f"File {fname} is larger than {MAX_ENTRY_SIZE} bytes, skipping")
+                continue
             
-            if not files_to_process:
-                logging.warning(f"No relevant files found in {archive_path}")
-                return price_data
+            entries.append((fname, date_str, b''.join(entry.get_blocks())))
+    
+    return entries
+
 
-            logging.info(f"Found {len(files_to_process)} files to process.")
+def _read_entries_py7zr(archive, date_str, allowed_prefixes):
+    """
+    Reads the target prices files from the archive with py7zr.
+    
+    Returns a list of (file name, date, raw bytes) tuples.
+    """
+    entries = []
+    with py7zr.SevenZipFile(archive, mode='r') as z:
+        files_to_process = []
+        for info in z.list():
+            fname = info.filename
+            if not (fname.endswith(('/prices', '\\prices')) and fname.startswith(allowed_prefixes)):
+                continue
             
-            # Extract to a temporary directory
-            temp_extract_dir = Path(archive_path).parent / f"temp_{date_str}"
-            if temp_extract_dir.exists():
-                shutil.rmtree(temp_extract_dir)
+            if info.uncompressed and info.uncompressed > MAX_ENTRY_SIZE:
+                logging.error(f"File {fname} is larger than {MAX_ENTRY_SIZE} bytes, skipping")
+                continue
             
-            z.extract(targets=files_to_process, path=temp_extract_dir)
+            files_to_process.append(fname)
+        
+        if not files_to_process:
+            return entries
+        
+        # Decompress the target files straight into memory
+        factory = BytesIOFactory(MAX_ENTRY_SIZE)
+        z.extract(targets=files_to_process, factory=factory)
+        
+        # Collect the decompressed bytes for parsing
+        for fname in files_to_process:
+            buf = factory.products.pop(fname, None)
+            if buf is None:
+                logging.error(f"File {fname} was not found in the archive")
+                continue
             
-            # Process extracted files
-            for fname in files_to_process:
-                parts = fname.replace('\\', '/').split('/')
-                category_id = parts[1]
-                file_path = temp_extract_dir / fname
-                
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = json.load(f)
-                        
-                        items = []
-                        if isinstance(content, dict) and 'results' in content:
-                            items = content['results']
-                        elif isinstance(content, list):
-                            items = content
-                        elif isinstance(content, dict):
-                            items = [content]
-                        else:
-                            continue
-                            
-                        for item in items:
-                            product_id = item.get('productId')
-                            sub_type = item.get('subTypeName', 'Normal')
-                            
-                            if not product_id:
-                                continue
-                            
-                            # Extract price data
-                            record = {
-                                'date': date_str,
-                                'productId': product_id,
-                                'subTypeName': sub_type
-                            }
-                            
-                            for field in PRICE_FIELDS:
-                                record[field] = item.get(field)
-                            
-                            key = (category_id, str(product_id), sub_type)
-                            price_data[key].append(record)
-                            
-                except json.JSONDecodeError:
-                    logging.error(f"Failed to decode JSON in {fname}")
-                except Exception as e:
-                    logging.error(f"Error processing file {fname}: {e}")
-
-            # Cleanup temp dir
-            shutil.rmtree(temp_extract_dir)
+            buf.seek(0)
+            entries.append((fname, date_str, buf.read()))
+    
+    return entries
+
+
+def extract_prices_from_archive(archive, date_str, target_categories):
+    """
+    Extracts price data from the archive for the specified categories.
+    
+    archive is a path or a seekable binary file object.
+    Returns a dict: (category_id, product_id, subTypeName) -> list of PriceRecord
+    """
+    logging.info(f"Extracting prices for date {date_str}...")
+    
+    price_data = defaultdict(list)
+    
+    # Filter files for target categories
+    # Structure: {date}/{categoryId}/{groupId}/prices
+    allowed_prefixes = tuple(
+        f"{date_str}{sep}{category_id}{sep}"
+        for category_id in target_categories
+        for sep in ('/', '\\')
+    )
+    
+    try:
+        # Prefer native libarchive for decompression, fall back to py7zr
+        if libarchive is not None:
+            entries = _read_entries_libarchive(archive, date_str, allowed_prefixes)
+        else:
+            entries = _read_entries_py7zr(archive, date_str, allowed_prefixes)
+        
+        if not entries:
+            logging.warning(f"No relevant files found in archive for {date_str}")
+            return price_data
+        
+        logging.info(f"Found {len(entries)} files to process.")
+        
+        for fname, entry_date, data in entries:
+            _parse_prices_file(fname, entry_date, data, price_data)
             
     except Exception as e:
-        logging.error(f"Error processing archive {archive_path}: {e}")
+        logging.error(f"Error processing archive for {date_str}: {e}")
         raise
     
     return price_data
 
 
-def update_product_file(data_dir, category_id, product_id, sub_type, price_records):
+def update_product_file(category_dir, product_id, sub_type, price_records, today, pretty=False):
     """
     Update the product JSON file with price data from day 7 and day 30.
     Each file contains exactly 2 entries: one for day 7 and one for day 30.
+    The category directory must already exist.
     """
-    output_dir = Path(data_dir) / category_id
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_file = output_dir / f"{product_id}_{sub_type}.json"
+    output_file = category_dir / f"{product_id}_{sub_type}.json"
     
-    # Read existing data if file exists
-    existing_data = {}
-    if output_file.exists():
-        try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                existing_data = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            existing_data = {}
+    # Read existing data; a missing file is just an IOError
+    existing_bytes = None
+    try:
+        with open(output_file, 'rb') as f:
+            existing_bytes = f.read()
+        existing_data = json_loads(existing_bytes)
+    except (json.JSONDecodeError, IOError):
+        existing_data = {}
     
     # Update with new price records
     # price_records is a list of records (should be 1 or 2 items)
+    today_ord = today.toordinal()
     for record in price_records:
-        date_str = record['date']
-        
         # Determine if this is day 7 or day 30 data
-        today = datetime.datetime.now(datetime.timezone.utc).date()
-        record_date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
-        days_diff = (today - record_date).days
+        days_diff = today_ord - date_ordinal(record.date)
         
         if days_diff == 7:
             key = 'day7'
@@ -176,42 +355,35 @@ def update_product_file(data_dir, category_id, product_id, sub_type, price_recor
             continue
         
         # Store the price data
-        existing_data[key] = {
-            'date': date_str,
-            'lowPrice': record.get('lowPrice'),
-            'midPrice': record.get('midPrice'),
-            'highPrice': record.get('highPrice'),
-            'marketPrice': record.get('marketPrice'),
-            'directLowPrice': record.get('directLowPrice')
-        }
+        existing_data[key] = record._asdict()
     
     # Add metadata
     existing_data['productId'] = int(product_id)
     existing_data['subTypeName'] = sub_type
-    existing_data['lastUpdated'] = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+    existing_data['lastUpdated'] = today.isoformat()
     
-    # Write to file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(existing_data, f, indent=2)
+    # Write to file, unless the content is unchanged
+    payload = json_dumps(existing_data, pretty)
+    if payload != existing_bytes:
+        write_bytes(output_file, payload)
 
 
-def process_daily_data(archive_path, date_str, data_dir):
-    """
-    Process a single day's archive and update all product files.
+def update_product_files(price_data, data_dir, today, pretty=False):
     """
-    logging.info(f"Processing daily data for {date_str}...")
+    Update the product files for all products in price_data.
     
-    # Extract prices from archive
-    price_data = extract_prices_from_archive(archive_path, date_str, TARGET_CATEGORIES.keys())
-    
-    if not price_data:
-        logging.warning("No price data extracted.")
-        return
-    
-    # Update each product file
+    price_data may hold records from several days, so each product file is
+    read and written once no matter how many archives it came from.
+    """
     logging.info(f"Updating {len(price_data)} product files...")
     
+    # Create each category directory once rather than once per product
+    category_dirs = {}
     for (category_id, product_id, sub_type), records in price_data.items():
-        update_product_file(data_dir, category_id, product_id, sub_type, records)
-    
-    logging.info("Daily processing complete.")
+        category_dir = category_dirs.get(category_id)
+        if category_dir is None:
+            category_dir = Path(data_dir) / category_id
+            category_dir.mkdir(parents=True, exist_ok=True)
+            category_dirs[category_id] = category_dir
+        
+        update_product_file(category_dir, product_id, sub_type, records, today, pretty)